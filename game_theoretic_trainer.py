@@ -5,136 +5,17 @@ game_theoretic_trainer.py
 Train a single PPO agent (ego) against the GameTheoreticEnv opponent.
 """
 import argparse
-import time
-from typing import Tuple
 
 import gymnasium as gym
 import numpy as np
-import torch
 
-from ppo_trainer import PPOTrainer, seed_everything, MultiCategorical
-from torch.distributions import Normal
-from tqdm import trange
-
-from loguru import logger
+from ppo_trainer import PPOTrainer, seed_everything
 
 
 class PPOGameTrainer(PPOTrainer):
-    def collect_rollout(self, max_steps: int = 2048):
-        """Collect a rollout of experiences."""
-        states = []
-        actions = []
-        rewards = []
-        values = []
-        log_probs = []
-        dones = []
-
-        state, info = self.env.reset()
-        # state = state['state']  # Extract state from observation dict
-
-        episode_rewards = []
-        current_episode_reward = 0
-
-        for _ in trange(max_steps, desc='Collect'):
-            # Convert state to tensor
-            state_tensor = torch.FloatTensor(state).unsqueeze(0).to(self.device)
-
-            # Get action from policy
-            with torch.no_grad():
-                if self.discrete:
-                    logits = self.actor(state_tensor)
-                    dist = MultiCategorical(logits, self.n_logits)
-                else:
-                    mean, log_std = self.actor(state_tensor)
-                    std = log_std.exp()
-                    dist = Normal(mean, std)
-                action = dist.sample()
-                log_prob = dist.log_prob(action).sum(dim=-1)
-                value = self.critic(state_tensor)
-
-            action = action.detach().cpu().numpy()[0]
-            next_state, reward, terminated, truncated, info = self.env.step((action, dist))
-            # next_state = next_state['state']  # Extract state from observation dict
-            # done = terminated or truncated  # This is incorrect. Should use terminated.
-
-            # Store experience
-            states.append(state)
-            actions.append(action)
-            rewards.append(reward)
-            values.append(value.cpu().numpy()[0])
-            log_probs.append(log_prob.cpu().numpy())
-            # dones.append(done)
-            dones.append(terminated)
-
-            current_episode_reward += reward
-
-            if terminated or truncated:  # Reset on either condition.
-                episode_rewards.append(current_episode_reward)
-                current_episode_reward = 0
-                state, info = self.env.reset()
-                # state = state['state']
-            else:
-                state = next_state
-
-        # Get final value for GAE computation
-        with torch.no_grad():
-            state_tensor = torch.FloatTensor(state).unsqueeze(0).to(self.device)
-            final_value = self.critic(state_tensor).cpu().numpy()[0]
-
-        # Log episode rewards
-        if episode_rewards:
-            self.writer.add_scalar('rollout/mean_episode_reward', np.mean(episode_rewards), self.episode_count)
-            self.writer.add_scalar('rollout/max_episode_reward', np.max(episode_rewards), self.episode_count)
-            self.writer.add_scalar('rollout/min_episode_reward', np.min(episode_rewards), self.episode_count)
-
-        return (
-            np.array(states),
-            np.array(actions),
-            np.array(rewards),
-            np.array(values),
-            np.array(log_probs),
-            np.array(dones),
-            final_value
-        )
-
-    def evaluate_agent(self):
-        state, info = self.env.reset(options={'render': True})
-        terminated, truncated = False, False
-        min_rel_dist = np.inf
-        episode_reward = 0
-
-        with torch.no_grad():
-            while not truncated and not terminated:
-                state_tensor = torch.FloatTensor(state).unsqueeze(0).to(self.device)
-                if not self.discrete:
-                    mean, log_std = self.actor(state_tensor)
-                    dist = Normal(mean, log_std.exp())
-                else:
-                    logits = self.actor(state_tensor)
-                    dist = MultiCategorical(logits, self.n_logits)
-                action = dist.sample().cpu().numpy()[0]
-                state, reward, terminated, truncated, info = self.env.step((action, dist))
-                min_rel_dist = min(min_rel_dist, info['relative_distance'])
-                episode_reward += reward
-
-        # Log evaluation metrics
-        self.writer.add_scalar('eval/episode_reward', episode_reward, self.episode_count)
-        self.writer.add_scalar('eval/min_relative_distance', min_rel_dist, self.episode_count)
-
-        if info['success']:
-            self.success_count += 1
-            logger.info(f"Successful overtaking! Episode {self.episode_count}")
-            self.writer.add_scalar('eval/success', 1, self.episode_count)
-        else:
-            logger.info(f"Failed to overtake. Episode {self.episode_count}")
-            logger.info(f"Min relative distance: {min_rel_dist}")
-            self.writer.add_scalar('eval/success', 0, self.episode_count)
-        logger.info(f"Success rate: {self.success_count}/{self.episode_count + 1}")
-
-        # Log training time
-        elapsed_time = time.time() - self.start_time
-        self.writer.add_scalar('time/elapsed_seconds', elapsed_time, self.episode_count)
-        self.writer.add_scalar('time/episodes_per_second', self.episode_count / elapsed_time, self.episode_count)
+    def env_step(self, env, action, policy_out):
+        """The game-theoretic env samples the ego's candidate actions from its policy distribution."""
+        return env.step((action, self.policy_distribution(policy_out)))
 
 
 # from gym_carla.envs.barc.game_theoretic_env import GameTheoreticEnv
@@ -28,8 +28,10 @@ def seed_everything(seed: int):
     os.environ['PYTHONHASHSEED'] = str(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
-    torch.cuda.manual_seed(seed)
-    torch.mps.manual_seed(seed)
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed(seed)
+    if torch.backends.mps.is_available():
+        torch.mps.manual_seed(seed)
     torch.backends.cudnn.deterministic = True
     torch.backends.cudnn.benchmark = False
 
@@ -132,12 +134,13 @@ class PPOSelfPlayTrainer:
         log_dir: Optional[str] = None,
         model_name: str = 'ppo_selfplay',
         comment: Optional[str] = None,
-        n_actions_per_dim: int = 10
+        n_actions_per_dim: int = 10,
+        max_steps: int = 2048
     ):
         self.env = env
         
         # Get state and action dimensions from environment
-        state_dim = self.env.observation_space['ego'].shape[0]
+        state_dim = self.state_dim = self.env.observation_space['ego'].shape[0]
         if isinstance(self.env.action_space['ego'], gym.spaces.MultiDiscrete):
             self.n_logits = self.env.action_space['ego'].nvec
             self.action_dim = len(self.env.action_space['ego'].nvec)
@@ -170,6 +173,9 @@ class PPOSelfPlayTrainer:
         self.max_grad_norm = max_grad_norm
         self.device = device
 
+        # Preallocate rollout arrays
+        self.allocate_rollout_arrays(max_steps)
+
         self.episode_count = 0
         self.success_count = 0
         
@@ -217,6 +223,15 @@ class PPOSelfPlayTrainer:
         # Log hyperparameters
         self.log_hyperparameters()
     
+    def allocate_rollout_arrays(self, max_steps: int):
+        """Allocate the arrays that collect_rollout writes `max_steps` transitions into."""
+        self._np_states = np.empty((max_steps, self.state_dim), dtype=np.float32)
+        self._np_actions = np.empty((max_steps, self.action_dim), dtype=np.float32)
+        self._np_rewards = np.empty(max_steps, dtype=np.float32)
+        self._np_values = np.empty(max_steps, dtype=np.float32)
+        self._np_log_probs = np.empty(max_steps, dtype=np.float32)
+        self._np_dones = np.empty(max_steps, dtype=np.float32)
+
     def log_hyperparameters(self):
         """Log hyperparameters to TensorBoard."""
         hparams = {
@@ -346,11 +361,11 @@ class PPOSelfPlayTrainer:
                 break
             
             # Update networks
-            self.actor_optimizer.zero_grad()
-            self.critic_optimizer.zero_grad()
+            self.actor_optimizer.zero_grad(set_to_none=True)
+            self.critic_optimizer.zero_grad(set_to_none=True)
             total_loss.backward()
-            nn.utils.clip_grad_norm_(self.actor.parameters(), self.max_grad_norm)
-            nn.utils.clip_grad_norm_(self.critic.parameters(), self.max_grad_norm)
+            nn.utils.clip_grad_norm_(list(self.actor.parameters()) + list(self.critic.parameters()),
+                                     self.max_grad_norm)
             self.actor_optimizer.step()
             self.critic_optimizer.step()
         
@@ -367,12 +382,8 @@ class PPOSelfPlayTrainer:
 
     def collect_rollout(self, max_steps: int = 2048) -> Tuple[np.ndarray, ...]:
         """Collect a rollout of experiences using self-play."""
-        states = []
-        actions = []
-        rewards = []
-        values = []
-        log_probs = []
-        dones = []
+        if self._np_states.shape[0] != max_steps:
+            self.allocate_rollout_arrays(max_steps)
 
         ego_wins, oppo_wins, draws, truncations, ego_losses, oppo_losses = 0, 0, 0, 0, 0, 0
         ego_avg_speed, oppo_avg_speed = 0, 0
@@ -386,7 +397,7 @@ class PPOSelfPlayTrainer:
         ego_vehicle = random.choice([True, False])
         # logger.info(f"Logging from {"Ego" if ego_vehicle else "Oppo"} vehicle")
         
-        for _ in trange(max_steps, desc='Collect'):
+        for t in trange(max_steps, desc='Collect', mininterval=0.5, miniters=64):  # Throttle bar refreshes.
             # Infer the ego vehicle action
             # Convert state to tensor
             state_tensor = torch.FloatTensor(state['ego']).unsqueeze(0).to(self.device)
@@ -431,21 +442,21 @@ class PPOSelfPlayTrainer:
 
             # Store experience for ego vehicle
             if ego_vehicle:
-                states.append(state['ego'])
-                actions.append(action.detach().cpu().numpy()[0])
-                rewards.append(reward['ego'])  # Use ego vehicle's reward
-                values.append(value.cpu().numpy()[0])
-                log_probs.append(log_prob.cpu().numpy())
-                dones.append(terminated['ego'])  # Use ego vehicle's termination
+                self._np_states[t] = state['ego']
+                self._np_actions[t] = combined_action['ego']
+                self._np_rewards[t] = reward['ego']  # Use ego vehicle's reward
+                self._np_values[t] = value.cpu().numpy()[0]
+                self._np_log_probs[t] = log_prob.item()
+                self._np_dones[t] = terminated['ego']  # Use ego vehicle's termination
             
             else:
             # Store experience for opponent vehicle
-                states.append(state['oppo'])
-                actions.append(flipped_action.detach().cpu().numpy()[0])
-                rewards.append(reward['oppo'])  # Use opponent's reward
-                values.append(flipped_value.cpu().numpy()[0])
-                log_probs.append(flipped_log_prob.cpu().numpy())
-                dones.append(terminated['oppo'])  # Use opponent's termination
+                self._np_states[t] = state['oppo']
+                self._np_actions[t] = combined_action['oppo']
+                self._np_rewards[t] = reward['oppo']  # Use opponent's reward
+                self._np_values[t] = flipped_value.cpu().numpy()[0]
+                self._np_log_probs[t] = flipped_log_prob.item()
+                self._np_dones[t] = terminated['oppo']  # Use opponent's termination
             
             current_episode_reward += reward['ego'] if ego_vehicle else reward['oppo']
             ego_avg_speed += info['ego']['avg_eps_speed']
@@ -496,13 +507,14 @@ class PPOSelfPlayTrainer:
         logger.info(f"EW: {ego_wins}, OW: {oppo_wins}, EL: {ego_losses}, OL: {oppo_losses}, D: {draws}, G: {truncations}")
         logger.info(f"EV: {ego_avg_speed / max_steps:.2f}, OV: {oppo_avg_speed / max_steps:.2f}")
         
+        # These are the preallocated arrays themselves, so the next rollout overwrites them.
         return (
-            np.array(states),
-            np.array(actions),
-            np.array(rewards),
-            np.array(values),
-            np.array(log_probs),
-            np.array(dones),
+            self._np_states,
+            self._np_actions,
+            self._np_rewards,
+            self._np_values,
+            self._np_log_probs,
+            self._np_dones,
             final_value
         )
 
@@ -665,7 +677,8 @@ if __name__ == "__main__":
         env=env,
         env_name=env_name,
         model_name=model_name,
-        comment=params.comment
+        comment=params.comment,
+        max_steps=params.max_steps
     )
     
     if params.evaluation:
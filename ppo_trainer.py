@@ -6,12 +6,13 @@ import torch.optim as optim
 from numpy import floating
 from tqdm import trange
 
+import math
 import random
 # from gym_carla.controllers.barc_pid import PIDWrapper
 from gym_carla.controllers.barc_mpcc_conv import MPCCConvWrapper
 from loguru import logger
 import os
-from typing import Dict, Tuple, Optional, Union, Any
+from typing import Dict, Tuple, Optional, Union, Any, List, Callable
 from torch.utils.tensorboard import SummaryWriter
 from torch.distributions import Distribution, Categorical, Normal
 import torch.nn.functional as F
@@ -29,41 +30,157 @@ def seed_everything(seed: int):
     os.environ['PYTHONHASHSEED'] = str(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
-    torch.cuda.manual_seed(seed)
-    torch.mps.manual_seed(seed)
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed(seed)
+    if torch.backends.mps.is_available():
+        torch.mps.manual_seed(seed)
     torch.backends.cudnn.deterministic = True
     torch.backends.cudnn.benchmark = False
 
 
+@torch.jit.script
+def discounted_reverse_cumsum(x: torch.Tensor, discounts: torch.Tensor) -> torch.Tensor:
+    """Compute y[t] = x[t] + discounts[t] * y[t + 1] along the leading (time) dimension."""
+    out = torch.empty_like(x)
+    acc = torch.zeros_like(x[0])
+    for t in range(x.shape[0] - 1, -1, -1):
+        acc = x[t] + discounts[t] * acc
+        out[t] = acc
+    return out
+
+
+@torch.jit.script
+def sample_and_logprob_multicat(logits: torch.Tensor, split_sizes: List[int]) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Draw one action per categorical head from concatenated logits with the Gumbel-max trick, and return it together
+    with its log-probability summed over the heads.
+    """
+    actions = []
+    log_prob = torch.zeros(logits.shape[:-1], dtype=logits.dtype, device=logits.device)
+    for head in torch.split(logits, split_sizes, dim=-1):
+        head_log_probs = F.log_softmax(head, dim=-1)
+        gumbels = -torch.empty_like(head_log_probs).exponential_().log()
+        action = (head_log_probs + gumbels).argmax(dim=-1, keepdim=True)
+        log_prob = log_prob + head_log_probs.gather(-1, action).squeeze(-1)
+        actions.append(action.squeeze(-1))
+    return torch.stack(actions, dim=-1), log_prob
+
+
+@torch.jit.script
+def sample_and_logprob_normal(mean: torch.Tensor, log_std: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Draw an action from a diagonal Normal, and return it together with its log-probability summed over dims."""
+    noise = torch.randn_like(mean)
+    action = mean + log_std.exp() * noise
+    # (action - mean) / std is the noise itself.
+    log_prob = (-0.5 * noise.pow(2) - log_std - 0.5 * math.log(2 * math.pi)).sum(dim=-1)
+    return action, log_prob
+
+
+def ppo_loss(
+    new_log_probs: torch.Tensor,
+    old_log_probs: torch.Tensor,
+    advantages: torch.Tensor,
+    values: torch.Tensor,
+    returns: torch.Tensor,
+    entropy: torch.Tensor,
+    clip_ratio: float
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Return the total PPO loss, the value loss and the approximate KL divergence, all as tensors."""
+    # Compute ratio and clipped surrogate loss
+    ratio = torch.exp(new_log_probs - old_log_probs)
+    clip_adv = torch.clamp(ratio, 1 - clip_ratio, 1 + clip_ratio) * advantages
+    actor_loss = -torch.min(ratio * advantages, clip_adv).mean()
+
+    # Compute value loss
+    value_loss = F.mse_loss(values, returns)
+
+    # Compute total loss
+    total_loss = actor_loss + 0.5 * value_loss - 0.01 * entropy
+
+    # Compute approximate KL divergence via Monte Carlo
+    kl_div = (old_log_probs - new_log_probs).mean()
+
+    return total_loss, value_loss, kl_div
+
+
+def make_vector_env(env_fns: List[Callable[[], gym.Env]], asynchronous: bool = False) -> gym.vector.VectorEnv:
+    """
+    Build a vector env whose sub-envs reset within the step that finishes an episode, like the single-env rollout.
+    """
+    vector_env_cls = gym.vector.AsyncVectorEnv if asynchronous else gym.vector.SyncVectorEnv
+    kwargs = {}
+    if hasattr(gym.vector, 'AutoresetMode'):  # gymnasium >= 1.0 defaults to next-step autoreset.
+        kwargs['autoreset_mode'] = gym.vector.AutoresetMode.SAME_STEP
+    return vector_env_cls(env_fns, **kwargs)
+
+
+def step_info(info: Dict[str, Any], key: str, done: np.ndarray) -> np.ndarray:
+    """
+    Per-env `info[key]` of a vector env step, where the entries of envs that finished on this step are taken from
+    `final_info`. With same-step autoreset the top-level info of a finished env already belongs to the new episode.
+
+    Handles both `final_info` layouts: a dict of arrays (gymnasium >= 1.0) and an object array of per-env dicts, with
+    None for the envs that did not finish (gymnasium < 1.0).
+    """
+    values = np.array(info[key]) if key in info else np.zeros(done.shape)
+    if 'final_info' not in info:
+        return values
+    final_info = info['final_info']
+    finished = np.asarray(info.get('_final_info', done), dtype=bool)
+    if isinstance(final_info, dict):
+        values[finished] = np.asarray(final_info[key])[finished]
+    else:
+        for i in np.flatnonzero(finished):
+            values[i] = final_info[i][key]
+    return values
+
+
 class MultiCategorical(Distribution):
     arg_constraints = {}  # Optional: constraints on arguments (skip for now)
     has_rsample = False   # Cannot reparameterize sampling for discrete actions
 
     def __init__(self, logits: torch.Tensor, nvec: list):
         super().__init__(batch_shape=logits.shape[:-1], event_shape=torch.Size([len(nvec)]))
-        self.nvec = list(nvec)
+        self.nvec = [int(n) for n in nvec]
         self.split_logits = torch.split(logits, self.nvec, dim=-1)
-        self.categoricals = [Categorical(logits=logit) for logit in self.split_logits]
+        # With equally sized heads, one Categorical over a (..., n_heads, n) view batches every op across the heads.
+        self.uniform = all(n == self.nvec[0] for n in self.nvec)
+        if self.uniform:
+            self.logits_rs = logits.view(*self.batch_shape, len(self.nvec), self.nvec[0])
+            self.categorical = Categorical(logits=self.logits_rs)
+        else:
+            self.categoricals = [Categorical(logits=logit) for logit in self.split_logits]
 
     def sample(self, sample_shape=torch.Size()) -> torch.Tensor:
+        if self.uniform:
+            return self.categorical.sample(sample_shape)
         samples = [dist.sample(sample_shape) for dist in self.categoricals]
         # Each sample has shape: sample_shape + batch_shape
         # Stack them to create final shape: sample_shape + batch_shape + event_shape
         return torch.stack(samples, dim=-1)
 
     def log_prob(self, actions: torch.Tensor):
-        log_probs = [
-            dist.log_prob(actions[..., i])
-            for i, dist in enumerate(self.categoricals)
-        ]
-        return torch.stack(log_probs, dim=-1).sum(dim=-1)
+        actions = actions.long()
+        if self.uniform:
+            return self.categorical.log_prob(actions).sum(dim=-1)
+        log_prob = 0.
+        for i, (logits, n) in enumerate(zip(self.split_logits, self.nvec)):
+            action = actions[..., i]
+            # cross_entropy wants (N, C) inputs, so broadcast against the actions and flatten the batch dimensions.
+            logits = logits.expand(action.shape + logits.shape[-1:]).reshape(-1, n)
+            log_prob = log_prob - F.cross_entropy(logits, action.reshape(-1), reduction='none').reshape(action.shape)
+        return log_prob
 
     def entropy(self):
+        if self.uniform:
+            return self.categorical.entropy().sum(dim=-1)
         entropies = [dist.entropy() for dist in self.categoricals]
         return torch.stack(entropies, dim=-1).sum(dim=-1)
 
     def mode(self):
         """Return the mode (argmax) of each categorical."""
+        if self.uniform:
+            return torch.argmax(self.logits_rs, dim=-1)
         modes = [torch.argmax(logits, dim=-1) for logits in self.split_logits]
         return torch.stack(modes, dim=-1)
     
@@ -71,50 +188,43 @@ class MultiCategorical(Distribution):
 @register_kl(MultiCategorical, MultiCategorical)
 def _kl_multi(m1, m2):
     # sum of per-dim KLs
+    if m1.uniform and m2.uniform:
+        return torch.distributions.kl_divergence(m1.categorical, m2.categorical).sum(dim=-1)
+    categoricals1 = [Categorical(logits=logit) for logit in m1.split_logits] if m1.uniform else m1.categoricals
+    categoricals2 = [Categorical(logits=logit) for logit in m2.split_logits] if m2.uniform else m2.categoricals
     return sum(torch.distributions.kl_divergence(d1, d2)
-               for d1, d2 in zip(m1.categoricals, m2.categoricals))
+               for d1, d2 in zip(categoricals1, categoricals2))
 
 
-# Actor Network
-class Actor(nn.Module):
+# Actor-Critic Network
+class ActorCritic(nn.Module):
     def __init__(self, state_dim: int, action_dim: int, n_actions_per_dim: np.ndarray, hidden_dim: int = 256,
                  discrete: bool = False):
-        super(Actor, self).__init__()
+        super(ActorCritic, self).__init__()
         self.action_dim = action_dim
         self.n_actions_per_dim = n_actions_per_dim
         self.discrete = discrete
         
-        self.net = nn.Sequential(
+        # The policy and value heads share one backbone, so a single forward pass serves both.
+        self.trunk = nn.Sequential(
             nn.Linear(state_dim, hidden_dim),
             nn.Tanh(),
             nn.Linear(hidden_dim, hidden_dim),
             nn.Tanh(),
-            nn.Linear(hidden_dim, np.sum(n_actions_per_dim) if discrete else action_dim * 2)
         )
-        
-    def forward(self, state: torch.Tensor) -> Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
-        x = self.net(state)
+        self.policy_head = nn.Linear(hidden_dim, np.sum(n_actions_per_dim) if discrete else action_dim * 2)
+        self.value_head = nn.Linear(hidden_dim, 1)
+        
+    def forward(self, state: torch.Tensor) -> Tuple[Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]],
+                                                    torch.Tensor]:
+        x = self.trunk(state)
+        value = self.value_head(x).squeeze(-1)
+        policy_out = self.policy_head(x)
         if not self.discrete:
-            mean, log_std = torch.chunk(x, 2, dim=-1)
+            mean, log_std = torch.chunk(policy_out, 2, dim=-1)
             log_std = torch.clamp(log_std, -20, 2)  # Prevent too small or large std.
-            return mean, log_std  # These are the mean and log_std for Normal distributions.
-        return x  # These are logits, and they will be used to form a MultiCategorical distribution later.
-
-
-# Critic Network
-class Critic(nn.Module):
-    def __init__(self, state_dim: int, hidden_dim: int = 256):
-        super(Critic, self).__init__()
-        self.net = nn.Sequential(
-            nn.Linear(state_dim, hidden_dim),
-            nn.Tanh(),
-            nn.Linear(hidden_dim, hidden_dim),
-            nn.Tanh(),
-            nn.Linear(hidden_dim, 1)
-        )
-        
-    def forward(self, state: torch.Tensor) -> torch.Tensor:
-        return self.net(state).squeeze(1)
+            return (mean, log_std), value  # These are the mean and log_std for Normal distributions.
+        return policy_out, value  # The logits will be used to form a MultiCategorical distribution later.
 
 
 class PPOTrainer:
@@ -133,46 +243,78 @@ class PPOTrainer:
         log_dir: Optional[str] = None,
         model_name: str = 'ppo',
         comment: Optional[str] = None,
-        n_actions_per_dim: int = 10
+        n_actions_per_dim: int = 10,
+        max_steps: int = 2048,
+        eval_env: Optional[gym.Env] = None,
+        n_epochs: int = 10,
+        minibatch_size: int = 64,
+        compile_model: bool = False
     ):
+        # Training can run on a single env or on a vector env, whose sub-envs are stepped with one batched forward.
         self.env = env
+        self.vectorized = isinstance(env, gym.vector.VectorEnv)
+        self.num_envs = env.num_envs if self.vectorized else 1
+        self.envs_seeded = False
+        if eval_env is None:
+            if self.vectorized:
+                raise ValueError("An eval_env is required when training on a vector env.")
+            eval_env = env
+        self.eval_env = eval_env
         
         # Get state and action dimensions from environment
-        state_dim = self.env.observation_space.shape[0]
-        if isinstance(self.env.action_space, gym.spaces.MultiDiscrete):
-            self.n_logits = self.env.action_space.nvec
-            self.action_dim = len(self.env.action_space.nvec)
+        observation_space = env.single_observation_space if self.vectorized else env.observation_space
+        action_space = env.single_action_space if self.vectorized else env.action_space
+        state_dim = self.state_dim = observation_space.shape[0]
+        if isinstance(action_space, gym.spaces.MultiDiscrete):
+            self.n_logits = action_space.nvec
+            self.action_dim = len(action_space.nvec)
             self.discrete = True
-        elif isinstance(self.env.action_space, gym.spaces.Discrete):
-            self.n_logits = np.array([self.env.action_space.n])
+        elif isinstance(action_space, gym.spaces.Discrete):
+            self.n_logits = np.array([action_space.n])
             self.action_dim = 1
             self.discrete = True
-        elif isinstance(self.env.action_space, gym.spaces.Box):
+        elif isinstance(action_space, gym.spaces.Box):
             self.n_logits = None
-            self.action_dim = self.env.action_space.shape[0]
+            self.action_dim = action_space.shape[0]
             self.discrete = False
         else:
-            raise NotImplementedError(f"Unsupported action space: {self.env.action_space}")
+            raise NotImplementedError(f"Unsupported action space: {action_space}")
+        # Plain ints, so the logits can be split inside TorchScript.
+        self.split_sizes = [int(n) for n in self.n_logits] if self.discrete else []
 
         # Initialize networks
-        self.actor = Actor(state_dim, action_dim=self.action_dim, n_actions_per_dim=self.n_logits,
-                           hidden_dim=hidden_dim, discrete=self.discrete).to(device)
-        self.critic = Critic(state_dim, hidden_dim).to(device)
-        
-        # Initialize optimizers
-        self.actor_optimizer = optim.Adam(self.actor.parameters(), lr=learning_rate)
-        self.critic_optimizer = optim.Adam(self.critic.parameters(), lr=learning_rate)
+        self.ac = ActorCritic(state_dim, action_dim=self.action_dim, n_actions_per_dim=self.n_logits,
+                              hidden_dim=hidden_dim, discrete=self.discrete).to(device)
         
+        # Initialize optimizer
+        self.optimizer = optim.Adam(self.ac.parameters(), lr=learning_rate)
+
         # Store hyperparameters
         self.gamma = gamma
         self.gae_lambda = gae_lambda
         self.clip_ratio = clip_ratio
         self.target_kl = target_kl
         self.max_grad_norm = max_grad_norm
+        self.n_epochs = n_epochs
+        # A fixed size rather than a fixed count, so the number of minibatches per epoch scales with num_envs.
+        self.minibatch_size = minibatch_size
         self.device = device
+        # bf16 rollout forwards, see autocast
+        self.use_autocast = torch.device(device).type == 'cuda'
+        # Side stream for rollout-time device work, see collect_rollout
+        self.collect_stream = torch.cuda.Stream(device=device) if torch.device(device).type == 'cuda' else None
+
+        # Optionally compile the network and the loss, whose small ops are otherwise dominated by launch overhead.
+        self.ppo_loss = ppo_loss
+        if compile_model:
+            self.compile_model()
+
+        # Preallocate rollout buffers
+        self.allocate_rollout_buffers(max_steps)
 
         self.episode_count = 0
         self.success_count = 0
+        self.eval_episode_count = 0
         
         # Store environment and model info
         self.env_name = env_name
@@ -218,6 +360,51 @@ class PPOTrainer:
         # Log hyperparameters
         self.log_hyperparameters()
     
+    def compile_model(self):
+        """
+        Compile the actor-critic and the PPO loss, falling back to eager execution if compilation fails.
+
+        torch.compile is lazy: backend failures (no Triton, unsupported ops, ...) only surface on the first call. So the
+        in-place compiled actor-critic and the compiled loss are warmed up on dummy inputs here, and the compilation is
+        undone if anything fails, including `nn.Module.compile` itself being unavailable (PyTorch < 2.2).
+        """
+        try:
+            self.ac.compile(mode='reduce-overhead')  # In place, so state_dict keys are unchanged.
+            compiled_loss = torch.compile(ppo_loss)
+            with torch.inference_mode(), self.autocast():
+                self.ac(torch.zeros(self.num_envs, self.state_dim, device=self.device))
+            policy_out, values = self.ac(torch.zeros(self.minibatch_size, self.state_dim, device=self.device))
+            zeros = torch.zeros_like(values)
+            total_loss, _, _ = compiled_loss(values, zeros, zeros, values, zeros, zeros.mean(), self.clip_ratio)
+            total_loss.backward()
+        except Exception as e:
+            logger.warning(f"torch.compile failed, running eagerly: {e}")
+            # Drop the compiled forward that nn.Module.compile installed, if it got that far.
+            if getattr(self.ac, '_compiled_call_impl', None) is not None:
+                self.ac._compiled_call_impl = None
+            return
+        finally:
+            self.optimizer.zero_grad(set_to_none=True)
+        self.ppo_loss = compiled_loss
+
+    def allocate_rollout_buffers(self, max_steps: int):
+        """
+        Allocate rollout buffers for `max_steps` transitions of each of the `self.num_envs` envs.
+
+        Env-side data (states, actions, rewards, dones) lives on the host, page-locked when training on CUDA so each
+        rollout is shipped to the device in a single non-blocking copy per buffer. Values and log-probs come out of the
+        policy forward, so they are written straight into device buffers without a per-step device-to-host sync.
+        """
+        pin_memory = torch.device(self.device).type == 'cuda'
+        shape = (max_steps, self.num_envs)
+        self.buf_states = torch.empty((*shape, self.state_dim), dtype=torch.float32, pin_memory=pin_memory)
+        self.buf_actions = torch.empty((*shape, self.action_dim), dtype=torch.float32, pin_memory=pin_memory)
+        self.buf_rewards = torch.empty(shape, dtype=torch.float32, pin_memory=pin_memory)
+        self.buf_values = torch.empty(shape, dtype=torch.float32, device=self.device)
+        # Only filled on the fp32 path, see collect_rollout
+        self.buf_logps = torch.empty(shape, dtype=torch.float32, device=self.device)
+        self.buf_dones = torch.empty(shape, dtype=torch.float32, pin_memory=pin_memory)
+
     def log_hyperparameters(self):
         """Log hyperparameters to TensorBoard."""
         hparams = {
@@ -228,9 +415,11 @@ class PPOTrainer:
             'clip_ratio': self.clip_ratio,
             'target_kl': self.target_kl,
             'max_grad_norm': self.max_grad_norm,
+            'n_epochs': self.n_epochs,
+            'minibatch_size': self.minibatch_size,
             'device': self.device,
-            'actor_hidden_dim': self.actor.net[0].out_features,
-            'critic_hidden_dim': self.critic.net[0].out_features,
+            'num_envs': self.num_envs,
+            'hidden_dim': self.ac.trunk[0].out_features,
         }
         
         # Add hyperparameters to TensorBoard
@@ -240,6 +429,34 @@ class PPOTrainer:
         hparams_text = "\n".join([f"{k}: {v}" for k, v in hparams.items()])
         self.writer.add_text('hyperparameters', hparams_text)
     
+    def autocast(self) -> torch.autocast:
+        """Autocast context for rollout-time forward passes, which never backprop: bf16 on CUDA, a no-op elsewhere."""
+        device_type = torch.device(self.device).type
+        return torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=self.use_autocast)
+
+    def state_to_tensor(self, state: np.ndarray) -> torch.Tensor:
+        """Move a batch of env states to the device, converting to fp32 at the numpy level without an extra copy."""
+        return torch.from_numpy(np.ascontiguousarray(state, dtype=np.float32)).to(self.device, non_blocking=True)
+
+    def policy_distribution(self, policy_out: Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]) -> Distribution:
+        """Build the action distribution from the actor head output, cast back to fp32."""
+        if self.discrete:
+            return MultiCategorical(policy_out.float(), self.n_logits)
+        mean, log_std = policy_out
+        return Normal(mean.float(), log_std.float().exp())
+
+    def sample_action(self, policy_out: Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]) \
+            -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Sample an action from the actor head output and return it with its log-probability, in fp32.
+
+        Unlike going through `policy_distribution`, this builds no Distribution objects.
+        """
+        if self.discrete:
+            return sample_and_logprob_multicat(policy_out.float(), self.split_sizes)
+        mean, log_std = policy_out
+        return sample_and_logprob_normal(mean.float(), log_std.float())
+
     def compute_gae(
         self,
         rewards: torch.Tensor,
@@ -247,22 +464,25 @@ class PPOTrainer:
         dones: torch.Tensor,
         next_value: torch.Tensor
     ) -> Tuple[torch.Tensor, torch.Tensor]:
-        """Compute Generalized Advantage Estimation."""
-        advantages = torch.zeros_like(rewards)
-        last_gae = 0
-        
-        for t in reversed(range(len(rewards))):
-            if t == len(rewards) - 1:
-                next_value_t = next_value
-            else:
-                next_value_t = values[t + 1]
-                
-            delta = rewards[t] + self.gamma * next_value_t * (1 - dones[t]) - values[t]
-            advantages[t] = last_gae = delta + self.gamma * self.gae_lambda * (1 - dones[t]) * last_gae
-            
+        """
+        Compute Generalized Advantage Estimation.
+
+        All inputs are expected on the same device. The time axis is the leading dimension, and `next_value` is the
+        bootstrap value of the state following the last step, with shape `values.shape[1:]`.
+        """
+        not_dones = 1. - dones
+        next_values = torch.cat([values[1:], next_value.reshape(1, *values.shape[1:])], dim=0)
+        deltas = rewards + self.gamma * next_values * not_dones - values
+        advantages = discounted_reverse_cumsum(deltas, self.gamma * self.gae_lambda * not_dones)
         returns = advantages + values
         return advantages, returns
     
+    def action_log_prob(self, dist: Distribution, actions: torch.Tensor) -> torch.Tensor:
+        """Log-probability of each action in the batch, summed over the action dimensions."""
+        if self.discrete:
+            return dist.log_prob(actions)
+        return dist.log_prob(actions).sum(dim=-1)
+
     def compute_ppo_loss(
         self,
         states: torch.Tensor,
@@ -272,88 +492,80 @@ class PPOTrainer:
         returns: torch.Tensor
     ) -> Tuple[torch.Tensor, torch.Tensor, float]:
         """Compute PPO loss for both actor and critic."""
-        # Get current policy distribution
-        if self.discrete:
-            logits = self.actor(states)
-            dist = MultiCategorical(logits=logits, nvec=self.n_logits)
-        else:
-            mean, log_std = self.actor(states)
-            std = log_std.exp()
-            dist = Normal(mean, std)
+        # Get current policy distribution and values
+        policy_out, values = self.ac(states)
+        dist = self.policy_distribution(policy_out)
 
         # Compute new log probs and entropy
-        if self.discrete:
-            new_log_probs = dist.log_prob(actions)
-        else:
-            new_log_probs = dist.log_prob(actions).sum(dim=-1)
+        new_log_probs = self.action_log_prob(dist, actions)
         entropy = dist.entropy().mean()
 
-        # Compute ratio and clipped surrogate loss
-        ratio = torch.exp(new_log_probs - old_log_probs)
-        clip_adv = torch.clamp(ratio, 1 - self.clip_ratio, 1 + self.clip_ratio) * advantages
-        actor_loss = -torch.min(ratio * advantages, clip_adv).mean()
-        
-        # Compute value loss
-        values = self.critic(states).squeeze()
-        value_loss = nn.MSELoss()(values, returns)
-        
-        # Compute total loss
-        total_loss = actor_loss + 0.5 * value_loss - 0.01 * entropy
-        
-        # Compute approximate KL divergence via Monte Carlo
-        kl_div = (old_log_probs - new_log_probs).mean().item()
+        total_loss, value_loss, kl_div = self.ppo_loss(
+            new_log_probs, old_log_probs, advantages, values, returns, entropy, self.clip_ratio
+        )
+        kl_div = kl_div.item()
         
         return total_loss, value_loss, kl_div
     
     def train_step(
         self,
-        states: np.ndarray,
-        actions: np.ndarray,
-        old_log_probs: np.ndarray,
-        advantages: np.ndarray,
-        returns: np.ndarray,
+        states: torch.Tensor,
+        actions: torch.Tensor,
+        old_log_probs: torch.Tensor,
+        advantages: torch.Tensor,
+        returns: torch.Tensor,
     ):
-        """Perform one step of PPO training."""
-        # Convert to tensors and move to device
-        states = torch.FloatTensor(states).to(self.device)
-        actions = torch.FloatTensor(actions).to(self.device)
-        old_log_probs = torch.FloatTensor(old_log_probs).to(self.device)
-        advantages = torch.FloatTensor(advantages).to(self.device)
-        returns = torch.FloatTensor(returns).to(self.device)
-        
-        # Normalize advantages
-        advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
+        """
+        Perform one step of PPO training. All inputs are expected on `self.device`.
+
+        `advantages` is normalized in place.
+        """
+        if self.use_autocast:
+            # The rollout log-probs come from a bf16 forward, while the loss re-evaluates the policy in fp32. Their
+            # rounding gap alone is on the order of target_kl, so recompute the behaviour log-probs in fp32 to start
+            # the ratio at 1.
+            with torch.no_grad():
+                policy_out, _ = self.ac(states)
+                old_log_probs = self.action_log_prob(self.policy_distribution(policy_out), actions)
+
+        # Normalize advantages in place, with mean and variance from a single fused reduction
+        var, mean = torch.var_mean(advantages, unbiased=False)
+        advantages.sub_(mean).div_(var.sqrt().add_(1e-8))
         
         # Track training metrics
         total_losses = []
         value_losses = []
         kl_divs = []
         
-        # Perform multiple epochs of training
-        for epoch in range(10):  # Number of epochs
-            # Compute loss
-            total_loss, value_loss, kl_div = self.compute_ppo_loss(
-                states, actions, old_log_probs, advantages, returns
-            )
-            
-            # Track metrics
-            total_losses.append(total_loss.item())
-            value_losses.append(value_loss.item())
-            kl_divs.append(kl_div)
-            
-            # Early stopping if KL divergence is too high
-            if kl_div > 1.5 * self.target_kl:
-                logger.info(f"Early stopping at KL divergence: {kl_div:.3f}")
+        # Perform multiple epochs of training over shuffled minibatches
+        batch_size = states.shape[0]
+        early_stop = False
+        for epoch in range(self.n_epochs):
+            indices = torch.randperm(batch_size, device=states.device)
+            for mb in torch.split(indices, self.minibatch_size):
+                # Compute loss
+                total_loss, value_loss, kl_div = self.compute_ppo_loss(
+                    states[mb], actions[mb], old_log_probs[mb], advantages[mb], returns[mb]
+                )
+                
+                # Track metrics
+                total_losses.append(total_loss.item())
+                value_losses.append(value_loss.item())
+                kl_divs.append(kl_div)
+                
+                # Early stopping if KL divergence is too high
+                if kl_div > 1.5 * self.target_kl:
+                    logger.info(f"Early stopping at KL divergence: {kl_div:.3f}")
+                    early_stop = True
+                    break
+                
+                # Update networks
+                self.optimizer.zero_grad(set_to_none=True)
+                total_loss.backward()
+                nn.utils.clip_grad_norm_(self.ac.parameters(), self.max_grad_norm)
+                self.optimizer.step()
+            if early_stop:
                 break
-            
-            # Update networks
-            self.actor_optimizer.zero_grad()
-            self.critic_optimizer.zero_grad()
-            total_loss.backward()
-            nn.utils.clip_grad_norm_(self.actor.parameters(), self.max_grad_norm)
-            nn.utils.clip_grad_norm_(self.critic.parameters(), self.max_grad_norm)
-            self.actor_optimizer.step()
-            self.critic_optimizer.step()
         
         # Calculate average metrics
         avg_total_loss = np.mean(total_losses)
@@ -366,66 +578,97 @@ class PPOTrainer:
             'kl_div': avg_kl_div
         }
 
-    def collect_rollout(self, max_steps: int = 2048) -> Tuple[np.ndarray, ...]:
-        """Collect a rollout of experiences."""
-        states = []
-        actions = []
-        rewards = []
-        values = []
-        log_probs = []
-        dones = []
+    def env_step(self, env: gym.Env, action: np.ndarray, policy_out: Any):
+        """Step `env` with the sampled `action`. `policy_out` is the actor head output the action was drawn from."""
+        return env.step(action)
+
+    def reset_envs(self) -> np.ndarray:
+        """Reset the training env(s) and return the batch of initial states."""
+        if self.vectorized and not self.envs_seeded:
+            # Async workers are forked with the same global np.random state, from which the envs draw their spawns.
+            # Seed the sub-envs once (seed + i for sub-env i), so they do not all replay the same episode.
+            state, info = self.env.reset(seed=int(np.random.randint(2 ** 31 - 1)))
+            self.envs_seeded = True
+        else:
+            state, info = self.env.reset()
+        return state if self.vectorized else state[None]
+
+    def step_envs(self, action: np.ndarray, policy_out: Any) -> Tuple[np.ndarray, ...]:
+        """
+        Step the training env(s) with a batch of actions.
+
+        Finished episodes are reset within the same step, so the returned states are always the ones to act on next.
+        """
+        if self.vectorized:
+            next_state, reward, terminated, truncated, info = self.env_step(self.env, action, policy_out)
+            return next_state, reward, terminated, truncated
+        next_state, reward, terminated, truncated, info = self.env_step(self.env, action[0], policy_out)
+        if terminated or truncated:  # Reset on either condition.
+            next_state, info = self.env.reset()
+        return next_state[None], np.array([reward]), np.array([terminated]), np.array([truncated])
+
+    def collect_rollout(self, max_steps: int = 2048) -> Tuple[torch.Tensor, ...]:
+        """
+        Collect a rollout of `max_steps` experiences per env, laid out as (max_steps, num_envs, ...).
+
+        The returned log-probs are only meaningful when `self.use_autocast` is off; otherwise train_step recomputes them.
+        """
+        if self.buf_states.shape[0] != max_steps:
+            self.allocate_rollout_buffers(max_steps)
         
-        state, info = self.env.reset()
+        state = self.reset_envs()
         # state = state['state']  # Extract state from observation dict
         
         episode_rewards = []
-        current_episode_reward = 0
-        
-        for _ in trange(max_steps, desc='Collect'):
-            # Convert state to tensor
-            state_tensor = torch.FloatTensor(state).unsqueeze(0).to(self.device)
-            
-            # Get action from policy
-            with torch.no_grad():
-                if self.discrete:
-                    logits = self.actor(state_tensor)
-                    dist = MultiCategorical(logits, self.n_logits)
-                else:
-                    mean, log_std = self.actor(state_tensor)
-                    std = log_std.exp()
-                    dist = Normal(mean, std)
-                action = dist.sample()
-                log_prob = dist.log_prob(action).sum(dim=-1)
-                value = self.critic(state_tensor)
-
-            action = action.detach().cpu().numpy()[0]
-            next_state, reward, terminated, truncated, info = self.env.step(action)
-            # next_state = next_state['state']  # Extract state from observation dict
-            # done = terminated or truncated  # This is incorrect. Should use terminated.
-
-            # Store experience
-            states.append(state)
-            actions.append(action)
-            rewards.append(reward)
-            values.append(value.cpu().numpy()[0])
-            log_probs.append(log_prob.cpu().numpy())
-            # dones.append(done)
-            dones.append(terminated)
+        current_episode_reward = np.zeros(self.num_envs)
+        
+        # On CUDA every device op of the rollout is queued on a dedicated stream and the host only waits for the actions.
+        if self.collect_stream is not None:
+            # Pick up the parameters written by the previous update on the default stream.
+            self.collect_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.collect_stream):
+            for t in trange(max_steps, desc='Collect', mininterval=0.5, miniters=64):  # Throttle bar refreshes.
+                # Stage the state in its pinned buffer slot, so the upload to the device can run asynchronously
+                self.buf_states[t].copy_(torch.from_numpy(state))
+                state_tensor = self.buf_states[t].to(self.device, non_blocking=True)
             
-            current_episode_reward += reward
+                # Get action from policy
+                with torch.inference_mode():
+                    with self.autocast():
+                        policy_out, value = self.ac(state_tensor)
+                    value = value.float()
+                    action, log_prob = self.sample_action(policy_out)
+                self.buf_values[t].copy_(value)
+                if not self.use_autocast:
+                    # Under autocast train_step recomputes these in fp32, so buf_logps is left unfilled then.
+                    self.buf_logps[t].copy_(log_prob)
+
+                # Only the action has to come back to the host, since env.step needs it. This is the one sync point.
+                action = action.cpu().numpy()
+                next_state, reward, terminated, truncated = self.step_envs(action, policy_out)
+                # done = terminated or truncated  # This is incorrect. Should use terminated.
+
+                # Store experience
+                self.buf_actions[t].copy_(torch.from_numpy(action))
+                self.buf_rewards[t].copy_(torch.from_numpy(reward))
+                # self.buf_dones[t] = done
+                self.buf_dones[t].copy_(torch.from_numpy(terminated))
             
-            if terminated or truncated:  # Reset on either condition.
-                episode_rewards.append(current_episode_reward)
-                current_episode_reward = 0
-                state, info = self.env.reset()
-                # state = state['state']
-            else:
+                current_episode_reward += reward
+                done = terminated | truncated
+                episode_rewards.extend(current_episode_reward[done])
+                current_episode_reward[done] = 0
                 state = next_state
 
-        # Get final value for GAE computation
-        with torch.no_grad():
-            state_tensor = torch.FloatTensor(state).unsqueeze(0).to(self.device)
-            final_value = self.critic(state_tensor).cpu().numpy()[0]
+            # Get final value for GAE computation
+            with torch.inference_mode(), self.autocast():
+                state_tensor = self.state_to_tensor(state)
+                _, final_value = self.ac(state_tensor)
+            # Copy out of the forward's output, which a compiled (CUDA-graphed) model reuses on the next call.
+            final_value = final_value.float().clone()  # Stays on self.device for GAE.
+        if self.collect_stream is not None:
+            # The update runs on the default stream and reads what the collection stream wrote.
+            torch.cuda.current_stream().wait_stream(self.collect_stream)
         
         # Log episode rewards
         if episode_rewards:
@@ -434,12 +677,12 @@ class PPOTrainer:
             self.writer.add_scalar('rollout/min_episode_reward', np.min(episode_rewards), self.episode_count)
         
         return (
-            np.array(states),
-            np.array(actions),
-            np.array(rewards),
-            np.array(values),
-            np.array(log_probs),
-            np.array(dones),
+            self.buf_states.to(self.device, non_blocking=True),
+            self.buf_actions.to(self.device, non_blocking=True),
+            self.buf_rewards.to(self.device, non_blocking=True),
+            self.buf_values,
+            self.buf_logps,
+            self.buf_dones.to(self.device, non_blocking=True),
             final_value
         )
     
@@ -451,22 +694,26 @@ class PPOTrainer:
             # Collect rollout
             states, actions, rewards, values, log_probs, dones, final_value = self.collect_rollout(max_steps)
             
-            # Compute advantages and returns
-            advantages, returns = self.compute_gae(
-                torch.FloatTensor(rewards),
-                torch.FloatTensor(values),
-                torch.FloatTensor(dones),
-                torch.FloatTensor([final_value])
-            )
+            # Compute advantages and returns along the time axis of each env
+            advantages, returns = self.compute_gae(rewards, values, dones, final_value)
             
-            # Perform PPO update
-            metrics = self.train_step(states, actions, log_probs, advantages, returns)
+            # Read before the update, which normalizes the advantages in place
+            mean_advantage = advantages.mean().item()
+            
+            # Perform PPO update on the flattened (max_steps * num_envs) batch
+            metrics = self.train_step(
+                states.flatten(0, 1),
+                actions.flatten(0, 1),
+                log_probs.flatten(0, 1),
+                advantages.flatten(0, 1),
+                returns.flatten(0, 1)
+            )
             
             # Log metrics to TensorBoard
             self.writer.add_scalar('train/total_loss', metrics['total_loss'], self.episode_count)
             self.writer.add_scalar('train/value_loss', metrics['value_loss'], self.episode_count)
             self.writer.add_scalar('train/kl_divergence', metrics['kl_div'], self.episode_count)
-            self.writer.add_scalar('train/mean_advantage', advantages.mean().item(), self.episode_count)
+            self.writer.add_scalar('train/mean_advantage', mean_advantage, self.episode_count)
             self.writer.add_scalar('train/mean_return', returns.mean().item(), self.episode_count)
             
             # Log metrics
@@ -483,38 +730,58 @@ class PPOTrainer:
             self.episode_count += 1
 
     def evaluate_agent(self):
-        state, info = self.env.reset(options={'render': True})
-        terminated, truncated = False, False
-        min_rel_dist = np.inf
-        episode_reward = 0
-        
-        with torch.no_grad():
-            while not truncated and not terminated:
-                state_tensor = torch.FloatTensor(state).unsqueeze(0).to(self.device)
-                if not self.discrete:
-                    mean, log_std = self.actor(state_tensor)
-                    dist = Normal(mean, log_std.exp())
+        """
+        Run one evaluation episode in every eval env.
+
+        A vectorized eval env is stepped with a single batched policy forward per step until each of its sub-envs has
+        finished its first episode; later episodes started by the autoreset are ignored.
+        """
+        eval_vectorized = isinstance(self.eval_env, gym.vector.VectorEnv)
+        if eval_vectorized:
+            # Fresh seed per call so the sub-envs (and repeated evaluations) do not replay the same spawns. No render
+            # option: vector resets pass the same options to every sub-env, and each would open its own figure.
+            state, info = self.eval_env.reset(seed=int(np.random.randint(2 ** 31 - 1)))
+        else:
+            state, info = self.eval_env.reset(options={'render': True})
+            state = state[None]
+        num_eval_envs = state.shape[0]
+        active = np.ones(num_eval_envs, dtype=bool)
+        successes = np.zeros(num_eval_envs, dtype=bool)
+        min_rel_dists = np.full(num_eval_envs, np.inf)
+        episode_rewards = np.zeros(num_eval_envs)
+
+        with torch.inference_mode():
+            while active.any():
+                state_tensor = self.state_to_tensor(state)
+                with self.autocast():
+                    policy_out, _ = self.ac(state_tensor)
+                action, _ = self.sample_action(policy_out)
+                action = action.cpu().numpy()
+                if eval_vectorized:
+                    state, reward, terminated, truncated, info = self.env_step(self.eval_env, action, policy_out)
+                    done = terminated | truncated
+                    rel_dist, success = step_info(info, 'relative_distance', done), step_info(info, 'success', done)
                 else:
-                    logits = self.actor(state_tensor)
-                    dist = MultiCategorical(logits, self.n_logits)
-                action = dist.sample().cpu().numpy()[0]
-                state, reward, terminated, truncated, info = self.env.step(action)
-                min_rel_dist = min(min_rel_dist, info['relative_distance'])
-                episode_reward += reward
-        
+                    state, reward, terminated, truncated, info = self.env_step(self.eval_env, action[0], policy_out)
+                    state, done = state[None], np.array([terminated or truncated])
+                    rel_dist, success = info['relative_distance'], info['success']
+                min_rel_dists = np.where(active, np.minimum(min_rel_dists, rel_dist), min_rel_dists)
+                episode_rewards += np.where(active, reward, 0.)
+                successes |= active & done & np.asarray(success, dtype=bool)
+                active &= ~done
+
         # Log evaluation metrics
-        self.writer.add_scalar('eval/episode_reward', episode_reward, self.episode_count)
-        self.writer.add_scalar('eval/min_relative_distance', min_rel_dist, self.episode_count)
-        
-        if info['success']:
-            self.success_count += 1
-            logger.info(f"Successful overtaking! Episode {self.episode_count}")
-            self.writer.add_scalar('eval/success', 1, self.episode_count)
-        else:
-            logger.info(f"Failed to overtake. Episode {self.episode_count}")
-            logger.info(f"Min relative distance: {min_rel_dist}")
-            self.writer.add_scalar('eval/success', 0, self.episode_count)
-        logger.info(f"Success rate: {self.success_count}/{self.episode_count + 1}")
+        self.writer.add_scalar('eval/episode_reward', episode_rewards.mean(), self.episode_count)
+        self.writer.add_scalar('eval/min_relative_distance', min_rel_dists.mean(), self.episode_count)
+        self.writer.add_scalar('eval/success', successes.mean(), self.episode_count)
+
+        n_success = int(successes.sum())
+        self.success_count += n_success
+        self.eval_episode_count += num_eval_envs
+        logger.info(f"Successful overtakes: {n_success}/{num_eval_envs}. Episode {self.episode_count}")
+        if n_success < num_eval_envs:
+            logger.info(f"Min relative distance of failed episodes: {min_rel_dists[~successes].min()}")
+        logger.info(f"Success rate: {self.success_count}/{self.eval_episode_count}")
         
         # Log training time
         elapsed_time = time.time() - self.start_time
@@ -529,10 +796,8 @@ class PPOTrainer:
         os.makedirs(checkpoint_root, exist_ok=True)
         
         torch.save({
-            'actor_state_dict': self.actor.state_dict(),
-            'critic_state_dict': self.critic.state_dict(),
-            'actor_optimizer_state_dict': self.actor_optimizer.state_dict(),
-            'critic_optimizer_state_dict': self.critic_optimizer.state_dict()
+            'ac_state_dict': self.ac.state_dict(),
+            'optimizer_state_dict': self.optimizer.state_dict()
         }, checkpoint_root / filename)
         logger.info(f"Model saved to {checkpoint_root / filename}")
     
@@ -542,10 +807,11 @@ class PPOTrainer:
         if not (checkpoint_root / filename).exists():
             raise ValueError(f"Checkpoint {checkpoint_root / filename} doesn't exist!")
         checkpoint = torch.load(checkpoint_root / filename)
-        self.actor.load_state_dict(checkpoint['actor_state_dict'])
-        self.critic.load_state_dict(checkpoint['critic_state_dict'])
-        self.actor_optimizer.load_state_dict(checkpoint['actor_optimizer_state_dict'])
-        self.critic_optimizer.load_state_dict(checkpoint['critic_optimizer_state_dict'])
+        if 'ac_state_dict' not in checkpoint:
+            raise ValueError(f"Checkpoint {checkpoint_root / filename} was saved with separate actor and critic "
+                             f"networks, which are incompatible with the shared-backbone ActorCritic.")
+        self.ac.load_state_dict(checkpoint['ac_state_dict'])
+        self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         logger.info(f"Model loaded from {checkpoint_root / filename}")
         
     def close(self):
@@ -558,8 +824,13 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--seed', type=int, default=42)
     parser.add_argument('--evaluation', action='store_true')
+    parser.add_argument('--eval_episodes', type=int, default=25, help='Envs evaluated side by side with --evaluation.')
     parser.add_argument('--n_epochs', type=int, default=1000)
-    parser.add_argument('--max_steps', type=int, default=2048)
+    parser.add_argument('--max_steps', type=int, default=2048, help='Rollout steps per env.')
+    parser.add_argument('--num_envs', type=int, default=8)
+    parser.add_argument('--sync_envs', action='store_true',
+                        help='Step the envs in the trainer process instead of one worker process per env.')
+    parser.add_argument('--compile', action='store_true', help='torch.compile the actor-critic and the PPO loss.')
     parser.add_argument('--resume', type=int, default=-1)
     parser.add_argument('-m', '--comment', type=str, default='experimental')
     params = parser.parse_args()
@@ -569,24 +840,41 @@ if __name__ == "__main__":
     env_name = "barc-v1-race"
     track_name = "L_track_barc"
     model_name = "ppo-mpcc"
-    # opponent = PIDWrapper(dt=0.1, t0=0., track_obj=get_track(track_name))
-    opponent = MPCCConvWrapper(dt=0.1, t0=0., track_obj=get_track(track_name))
-    env = gym.make(env_name, opponent=opponent, track_name=track_name, do_render=False, enable_camera=False,
-                   discrete_action=True)  # Initializing the env outside the trainer makes more sense.
+
+    def make_env():
+        # Each env owns its opponent, since the controllers are stateful.
+        # opponent = PIDWrapper(dt=0.1, t0=0., track_obj=get_track(track_name))
+        opponent = MPCCConvWrapper(dt=0.1, t0=0., track_obj=get_track(track_name))
+        return gym.make(env_name, opponent=opponent, track_name=track_name, do_render=False, enable_camera=False,
+                        discrete_action=True)  # Initializing the env outside the trainer makes more sense.
+
+    if params.evaluation:
+        # All evaluation episodes run side by side, one batched policy forward per step. Nothing is trained, so the
+        # eval envs also stand in for the training env.
+        eval_env = make_vector_env([make_env for _ in range(params.eval_episodes)], asynchronous=not params.sync_envs)
+        env = eval_env
+    else:
+        # The MPCC opponent makes env.step CPU-heavy, so by default each env steps in its own worker process.
+        env = make_vector_env([make_env for _ in range(params.num_envs)], asynchronous=not params.sync_envs)
+        eval_env = make_env()
 
     trainer = PPOTrainer(
         env=env,
+        eval_env=eval_env,
         env_name=env_name,
         model_name=model_name,
-        comment=params.comment
+        comment=params.comment,
+        max_steps=params.max_steps,
+        compile_model=params.compile
     )
     
     if params.evaluation:
         # raise UserWarning("Change the weight files first!")
         trainer.load_model('ppo_model_1000_barc-v1-race_ppo-mpcc.pt')
         # trainer.load_model(f'ppo_{params.comment}_latest.pth')
-        for _ in range(25):
-            trainer.evaluate_agent()
+        trainer.evaluate_agent()
+        trainer.close()
+        eval_env.close()
         exit(0)
     # Train the agent
     try:
@@ -597,3 +885,5 @@ if __name__ == "__main__":
     finally:
         trainer.save_model(f'ppo_{params.comment}_latest.pth')
         trainer.close()  # Close TensorBoard writer
+        env.close()  # Shut down the env worker processes
+        eval_env.close()
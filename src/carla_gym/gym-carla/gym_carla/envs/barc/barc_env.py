@@ -243,6 +243,11 @@ class BarcEnv(gym.Env):
             return
         self.visualizer.step(self.sim_state)
 
+    def close(self):
+        if self.camera_bridge is not None:
+            self.camera_bridge.close()  # Stops the DEBUG render thread
+        super().close()
+
     def _get_obs(self) -> Dict[str, np.ndarray]:
         ob = {
             'gps': np.array([self.sim_state.x.x, self.sim_state.x.y, self.sim_state.e.psi], dtype=np.float32),
@@ -260,6 +265,7 @@ class BarcEnv(gym.Env):
                     break
                 except RuntimeError as e:
                     logger.error(e)
+                self.camera_bridge.close()
                 from gym_carla.envs.barc.cameras.carla_bridge import CarlaConnector
                 while True:
                     time.sleep(10)
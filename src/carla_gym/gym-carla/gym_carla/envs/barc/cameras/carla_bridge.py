@@ -1,25 +1,47 @@
+import math
 import os
 import sys
 
 import numpy as np
 from loguru import logger
-from matplotlib import pyplot as plt
-# import cv2
+import cv2
 
 from mpclab_common.track import get_track
-from mpclab_common.pytypes import VehicleState
 
 import carla
 from pathlib import Path
+import queue
+import threading
 import time
 
-import pygame
-import skimage
+# pygame is imported where it is used: only the DEBUG window needs it, and each env worker imports this module.
 
 
 DEBUG = True
 
 
+# (height, width, display_size) -> (map1, map2, scratch) for rgb_to_display_surface
+_display_remaps = {}
+
+
+def build_display_remap(height, width, display_size):
+    """
+    Precompute the cv2.remap tables that resize a (height, width) image to (display_size, display_size) bilinearly and
+    swap its H and W axes in the same pass
+    :param height: source image height
+    :param width: source image width
+    :param display_size: display size
+    :return: fixed-point remap tables and an uint8 output buffer
+    """
+    # Same pixel-centre convention as cv2.resize with INTER_LINEAR. Output row i samples source column i, so the
+    # result comes out already transposed into the (width, height) layout surfarray expects.
+    src_col = (np.arange(display_size, dtype=np.float32) + 0.5) * (width / display_size) - 0.5
+    src_row = (np.arange(display_size, dtype=np.float32) + 0.5) * (height / display_size) - 0.5
+    map_x, map_y = np.meshgrid(src_col, src_row, indexing='ij')
+    map1, map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+    return map1, map2, np.empty((display_size, display_size, 3), dtype=np.uint8)
+
+
 def rgb_to_display_surface(rgb, display_size):
     """
     Generate pygame surface given an rgb image uint8 matrix
@@ -27,24 +49,36 @@ def rgb_to_display_surface(rgb, display_size):
     :param display_size: display size
     :return: pygame surface
     """
+    import pygame
+
     surface = pygame.Surface((display_size, display_size)).convert()
-    display = skimage.transform.resize(rgb, (display_size, display_size))
-    display = np.flip(display, axis=1)
-    display = np.rot90(display, 1)
+    key = (rgb.shape[0], rgb.shape[1], display_size)
+    if key not in _display_remaps:
+        _display_remaps[key] = build_display_remap(*key)
+    map1, map2, display = _display_remaps[key]
+    # Resize, flip and rot90 (a plain H/W transpose) in one uint8 pass over the pixels, with no allocation.
+    cv2.remap(rgb, map1, map2, cv2.INTER_LINEAR, dst=display, borderMode=cv2.BORDER_REPLICATE)
     pygame.surfarray.blit_array(surface, display)
     return surface
 
 
 class CarlaConnector:
-    def __init__(self, track_name, host='localhost', port=2000):
+    # Ego cameras sharing the world, see VectorCarlaConnector
+    num_cameras = 1
+
+    def __init__(self, track_name, host='localhost', port=2000, low_quality=True):
         # self.client = carla.Client('localhost', 2000)
         self.client = carla.Client(host, port)
         self.client.set_timeout(10.0)
 
         self.obs_size = 224
         self.dt = 0.1
+        self.sensor_timeout = 10.0  # seconds to wait for the frame of a tick
+        # Skip the camera's post-processing (bloom, motion blur, ...), which the policy does not need.
+        self.low_quality = low_quality
 
-        self.camera_img = np.empty((self.obs_size, self.obs_size, 3), dtype=np.uint8)
+        self.camera_imgs = np.empty((self.num_cameras, self.obs_size, self.obs_size, 3), dtype=np.uint8)
+        self.camera_img = self.camera_imgs[0]
         self.world = None
         self.camera_bp = None
         self.track_name = track_name
@@ -57,14 +91,61 @@ class CarlaConnector:
         self.env_steps = 0
         
         # Temporary: built-in rendering
-        if DEBUG:
-            pygame.init()
-            self.display = pygame.display.set_mode((224, 224), pygame.HWSURFACE | pygame.DOUBLEBUF)
-            self.surface = pygame.Surface((self.obs_size, self.obs_size))
-            self.clock = pygame.time.Clock()
-            # self.fig, self.ax = plt.subplots()
-            # self.im = self.ax.imshow(self.camera_img)
+        # The window is drawn by a background thread, so rendering never holds up world.tick(). It is only started
+        # on the first query: vector env workers are often forked after the env is built, and neither threads nor
+        # SDL state survive a fork.
+        self.render_queue = None
+        self.render_thread = None
+        # self.fig, self.ax = plt.subplots()
+        # self.im = self.ax.imshow(self.camera_img)
     
+    def start_renderer(self):
+        # Single slot: the renderer only ever shows the latest frame.
+        self.render_queue = queue.Queue(maxsize=1)
+        if sys.platform == 'darwin':
+            logger.warning("SDL windows must live on the main thread on macOS, the DEBUG window is disabled.")
+            return
+        self.render_thread = threading.Thread(target=self.render_loop, daemon=True)
+        self.render_thread.start()
+
+    def close(self):
+        # Stop the render thread and close its window, so a reconnecting env does not leave it running.
+        if self.render_thread is not None:
+            # Only this thread produces frames, so once drained the sentinel always fits.
+            while True:
+                try:
+                    self.render_queue.get_nowait()
+                except queue.Empty:
+                    break
+            self.render_queue.put_nowait(None)
+            self.render_thread.join(timeout=5.0)
+        self.render_queue = None
+        self.render_thread = None
+
+    def render_loop(self):
+        # All SDL calls stay on this thread, including creating the window.
+        import pygame
+
+        # The window is all that is needed, not the mixer, joystick, font, ... subsystems of pygame.init().
+        pygame.display.init()
+        # HWSURFACE / DOUBLEBUF are ignored by SDL2 for a software window like this one.
+        display = pygame.display.set_mode((self.obs_size, self.obs_size))
+        clock = pygame.time.Clock()
+        while True:
+            # Blocks until query_rgb_batch hands over a new frame, so the window is never flipped without a change.
+            frame = self.render_queue.get()
+            if frame is None:
+                break
+            # Write the frame straight into the window's pixels instead of going through an intermediate surface.
+            # The pixels3d view locks the display, so it has to be released before the flip.
+            pixels = pygame.surfarray.pixels3d(display)
+            pixels[...] = frame.swapaxes(0, 1)
+            del pixels
+            pygame.display.flip()
+            pygame.event.pump()
+            clock.tick(60)
+        pygame.display.quit()
+
     @property
     def height(self):
         return self.camera_img.shape[0]
@@ -104,6 +185,8 @@ class CarlaConnector:
         self.settings = self.world.get_settings()
         self.settings.synchronous_mode = True
         self.settings.fixed_delta_seconds = self.dt
+        # The camera is the only reason this connector exists, so the server has to render.
+        self.settings.no_rendering_mode = False
         self.world.apply_settings(self.settings)
 
     def destroy_camera(self):
@@ -118,58 +201,91 @@ class CarlaConnector:
         self.camera_bp.set_attribute('image_size_x', str(self.obs_size))
         self.camera_bp.set_attribute('image_size_y', str(self.obs_size))
         self.camera_bp.set_attribute('fov', '110')
-        # Set the time in seconds between sensor captures
-        self.camera_bp.set_attribute('sensor_tick', '0.02')
-
-        def get_camera_img(data):
-            array = np.frombuffer(data.raw_data, dtype=np.dtype("uint8"))
-            array = np.reshape(array, (data.height, data.width, 4))
-            array = array[:, :, :3]
-            array = array[:, :, ::-1]
-            self.camera_img = array
-
-        self.camera_trans = carla.Transform(carla.Location(x=x, y=y, z=0.2),
-                                            carla.Rotation(yaw=-np.rad2deg(psi)))
-        self.camera_sensor = self.world.spawn_actor(self.camera_bp, self.camera_trans)
-        self.camera_sensor.listen(get_camera_img)
-    
+        if self.low_quality:
+            self.camera_bp.set_attribute('enable_postprocess_effects', 'False')
+            self.camera_bp.set_attribute('motion_blur_intensity', '0')
+        # Set the time in seconds between sensor captures. 0.0 captures exactly once per world tick in synchronous
+        # mode, which is all query_rgb_batch consumes; sensor_tick == dt could skip a tick to float accumulation, and
+        # read_frame would then wait for a frame that never comes.
+        self.camera_bp.set_attribute('sensor_tick', '0.0')
+
+        # Frames are queued and matched against the tick that produced them in query_rgb_batch. Writing them from a
+        # listen() callback gives no guarantee that the frame of the tick just issued has arrived yet.
+        self.sensor_queues = [queue.Queue() for _ in range(self.num_cameras)]
+        self.camera_transes = []
+        self.camera_sensors = []
+        for sensor_queue in self.sensor_queues:
+            camera_trans = carla.Transform(carla.Location(x=x, y=y, z=0.2), carla.Rotation(yaw=-math.degrees(psi)))
+            camera_sensor = self.world.spawn_actor(self.camera_bp, camera_trans)
+            camera_sensor.listen(sensor_queue.put)
+            self.camera_transes.append(camera_trans)
+            self.camera_sensors.append(camera_sensor)
+
+    def place_cameras(self, states):
+        if len(states) != self.num_cameras:
+            raise ValueError(f"Expected {self.num_cameras} states, got {len(states)}.")
+        for state, camera_trans, camera_sensor in zip(states, self.camera_transes, self.camera_sensors):
+            # Reuse the transform from spawn_camera instead of building new carla objects on every step.
+            camera_trans.location.x = state.x.x
+            camera_trans.location.y = -state.x.y
+            camera_trans.rotation.yaw = -math.degrees(state.e.psi)
+            camera_sensor.set_transform(camera_trans)
+
+    def read_frame(self, sensor_queue, frame, out):
+        # Skip any frames left over from earlier ticks.
+        while True:
+            try:
+                image = sensor_queue.get(timeout=self.sensor_timeout)
+            except queue.Empty:
+                raise RuntimeError(f"No camera frame received for tick {frame} within {self.sensor_timeout}s.")
+            if image.frame >= frame:
+                break
+        # Zero-copy (H, W, 4) view of CARLA's BGRA buffer; copying it into a staging array first would only add a pass.
+        array = np.ndarray((image.height, image.width, 4), dtype=np.uint8, buffer=image.raw_data)
+        # A single channel-swapping pass straight into the preallocated RGB buffer, instead of the
+        # negative-stride `[:, :, :3][:, :, ::-1]` view that has to be materialized downstream.
+        cv2.cvtColor(array, cv2.COLOR_BGRA2RGB, dst=out)
+
     def query_rgb(self, state):
+        return self.query_rgb_batch([state])[0]
+
+    def query_rgb_batch(self, states):
+        """
+        Render every camera at its state with a single world tick
+        :param states: one VehicleState per camera
+        :return: (num_cameras, height, width, 3) uint8 rgb images
+        """
         self.env_steps += 1
-        if self.env_steps % 102_400 == 0:
-            self.destroy_camera()
+        self.place_cameras(states)
+        try:
+            frame = self.world.tick()
+        except RuntimeError as e:
+            # Only rebuild the world when the simulator actually timed out or restarted. If it is still down, the
+            # reload raises again and the env falls back to reconnecting.
+            logger.error(e)
+            logger.error("Reloading the OpenDrive map...")
             self.load_opendrive_map()
             self.spawn_camera()
-        # if time.time() - self.last_check > self.check_freq:
-        #     self.last_check = time.time()
-        #     if self.client.get_world().get_map().name != 'Carla/Maps/OpenDriveMap':
-        #         self.load_opendrive_map()
-        #         self.spawn_camera()
-        self.camera_sensor.set_transform(carla.Transform(carla.Location(x=state.x.x, y=-state.x.y, z=0.2), 
-                                                         carla.Rotation(yaw=-np.rad2deg(state.e.psi))))
-        # attempt = 0
-        # while True:
-        #     try:
-        self.world.tick()
+            self.place_cameras(states)
+            frame = self.world.tick()
+        for sensor_queue, camera_img in zip(self.sensor_queues, self.camera_imgs):
+            self.read_frame(sensor_queue, frame, camera_img)
+        # camera_imgs is overwritten on the next query, so hand out a snapshot.
+        rgb = self.camera_imgs.copy()
         if DEBUG:
             # surface = rgb_to_display_surface(self.camera_img, 256)
-            pygame.surfarray.blit_array(self.surface, self.camera_img.swapaxes(0, 1))
-            self.display.blit(self.surface, (0, 0))
-            pygame.display.flip()
-            self.clock.tick(60)
+            if self.render_queue is None:
+                self.start_renderer()
+            if self.render_thread is not None:
+                try:
+                    self.render_queue.put_nowait(rgb[0])
+                except queue.Full:
+                    pass  # Still drawing the previous frame; drop this one rather than wait.
             # self.im.set_array(self.camera_img)
             # plt.pause(0.01)
             # self.fig.canvas.draw()
             # self.fig.canvas.flush_events()
-        return self.camera_img
-        # except RuntimeError as e:
-        #     logger.error(e)
-        #     logger.error("Waiting for CARLA to restart...")
-        #     time.sleep(20)
-        #     self.load_opendrive_map()
-        #     self.spawn_camera(x=state.x.x, y=state.y.y, psi=state.e.psi)
-        #     attempt += 1
-        #     if attempt > 5:
-        #         raise RuntimeError(e)
+        return rgb
 
         # Built-in rendering
         # cv2.imshow('RGB Camera', self.camera_img[:, :, ::-1])
@@ -180,6 +296,8 @@ class CarlaConnector:
     def test(self):
         # fig, ax = plt.subplots()
         # im = ax.imshow(self.camera_img)
+        from mpclab_common.pytypes import VehicleState
+
         state = VehicleState()
         state.p.x_tran = 0.55
         
@@ -194,6 +312,16 @@ class CarlaConnector:
             # fig.canvas.flush_events()
 
 
+class VectorCarlaConnector(CarlaConnector):
+    """
+    Several ego cameras in one CARLA world. query_rgb_batch renders all of them with a single (busy-waiting) world
+    tick, instead of one server and one client per env.
+    """
+    def __init__(self, track_name, num_cameras, host='localhost', port=2000, low_quality=True):
+        self.num_cameras = num_cameras
+        super().__init__(track_name, host=host, port=port, low_quality=low_quality)
+
+
 if __name__ == '__main__':
     connector = CarlaConnector(track_name='L_track_barc')
     connector.spawn_camera()
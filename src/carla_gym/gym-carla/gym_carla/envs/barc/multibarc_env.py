@@ -298,6 +298,11 @@ class MultiBarcEnv(MultiAgentEnv):
             # return
         self.visualizer.step(self.sim_state)
 
+    def close(self):
+        if self.camera_bridge is not None:
+            self.camera_bridge.close()  # Stops the DEBUG render thread
+        super().close()
+
     def _get_obs(self) -> Dict[str, np.ndarray]:
         # For backward compatibility, use the first vehicle's state for gps and velocity
         ob = np.array([[state.v.v_long, state.v.v_tran, state.w.w_psi,
@@ -316,6 +316,11 @@ class RacingEnv(MultiAgentEnv):
     def render(self):
         self.visualizer.step(self.sim_state)
 
+    def close(self):
+        if self.camera_bridge is not None:
+            self.camera_bridge.close()  # Stops the DEBUG render thread
+        super().close()
+
     def _get_obs(self) -> Dict[str, np.ndarray]:
         ob = np.array([[state.v.v_long, state.v.v_tran, state.w.w_psi,
                         state.p.s, state.p.x_tran, state.p.e_psi,
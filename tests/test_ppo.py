@@ -1,6 +1,19 @@
+import numpy as np
 import torch
 import pytest
-from ppo_trainer import MultiCategorical
+import gymnasium as gym
+import gym_carla
+from torch.distributions import Categorical, Normal
+from mpclab_common.track import get_track
+from gym_carla.controllers.barc_pid import PIDWrapper
+from ppo_trainer import MultiCategorical, PPOTrainer, discounted_reverse_cumsum, make_vector_env, \
+    sample_and_logprob_multicat, sample_and_logprob_normal, step_info
+
+def make_barc_env():
+    track_name = "L_track_barc"
+    opponent = PIDWrapper(dt=0.1, t0=0., track_obj=get_track(track_name))
+    return gym.make('barc-v1-race', opponent=opponent, track_name=track_name, do_render=False, enable_camera=False,
+                    discrete_action=True)
 
 @pytest.fixture
 def example_logits_and_nvec():
@@ -11,6 +24,36 @@ def example_logits_and_nvec():
     logits = torch.randn(batch_size, total_logits)
     return logits, nvec
 
+@pytest.fixture
+def uniform_logits_and_nvec():
+    """Fixture with equally sized heads, which MultiCategorical handles as one batched Categorical."""
+    batch_size = 4
+    nvec = [6, 6, 6]
+    logits = torch.randn(batch_size, sum(nvec))
+    return logits, nvec
+
+@pytest.fixture
+def autocast_trainer(tmp_path):
+    """Fixture with a single-minibatch, single-epoch trainer whose rollout forwards run under bf16 autocast."""
+    env = make_barc_env()
+    trainer = PPOTrainer(env=env, device='cpu', log_dir=str(tmp_path), max_steps=64, n_epochs=1, minibatch_size=64)
+    trainer.use_autocast = True  # bf16 autocast is also supported on CPU
+    return trainer
+
+@pytest.fixture
+def sync_vector_trainer(tmp_path):
+    """Fixture with a trainer on two sub-envs stepped in the test process."""
+    env = make_vector_env([make_barc_env for _ in range(2)])
+    yield PPOTrainer(env=env, eval_env=make_barc_env(), device='cpu', log_dir=str(tmp_path), max_steps=16)
+    env.close()
+
+@pytest.fixture
+def async_vector_trainer(tmp_path):
+    """Fixture with a trainer on two sub-envs stepped in forked worker processes."""
+    env = make_vector_env([make_barc_env for _ in range(2)], asynchronous=True)
+    yield PPOTrainer(env=env, eval_env=make_barc_env(), device='cpu', log_dir=str(tmp_path), max_steps=8)
+    env.close()
+
 def test_sample_shape(example_logits_and_nvec):
     logits, nvec = example_logits_and_nvec
     dist = MultiCategorical(logits, nvec)
@@ -31,6 +74,50 @@ def test_log_prob_shape(example_logits_and_nvec):
     expected_shape = dist.batch_shape
     assert log_probs.shape == expected_shape, f"Expected shape {expected_shape}, got {log_probs.shape}"
 
+def test_log_prob_matches_per_head_categoricals(example_logits_and_nvec):
+    logits, nvec = example_logits_and_nvec
+    dist = MultiCategorical(logits, nvec)
+
+    samples = dist.sample()
+    expected = sum(Categorical(logits=head).log_prob(samples[..., i])
+                   for i, head in enumerate(torch.split(logits, nvec, dim=-1)))
+
+    assert torch.allclose(dist.log_prob(samples), expected)
+
+def test_sample_and_logprob_multicat(example_logits_and_nvec):
+    logits, nvec = example_logits_and_nvec
+
+    samples, log_probs = sample_and_logprob_multicat(logits, nvec)
+
+    assert samples.shape == (logits.shape[0], len(nvec))
+    for i, n in enumerate(nvec):
+        assert ((samples[:, i] >= 0) & (samples[:, i] < n)).all()
+    assert torch.allclose(log_probs, MultiCategorical(logits, nvec).log_prob(samples))
+
+def test_sample_and_logprob_normal():
+    mean = torch.randn(4, 2)
+    log_std = torch.randn(4, 2).clamp(-2, 1)
+
+    actions, log_probs = sample_and_logprob_normal(mean, log_std)
+
+    assert actions.shape == mean.shape
+    assert torch.allclose(log_probs, Normal(mean, log_std.exp()).log_prob(actions).sum(dim=-1), atol=1e-5)
+
+def test_uniform_heads_match_per_head_categoricals(uniform_logits_and_nvec):
+    logits, nvec = uniform_logits_and_nvec
+    dist = MultiCategorical(logits, nvec)
+    heads = [Categorical(logits=head) for head in torch.split(logits, nvec, dim=-1)]
+
+    samples = dist.sample(sample_shape=torch.Size((5,)))
+    assert samples.shape == torch.Size((5,)) + dist.batch_shape + dist.event_shape
+
+    expected_log_prob = sum(head.log_prob(samples[..., i]) for i, head in enumerate(heads))
+    expected_entropy = sum(head.entropy() for head in heads)
+    expected_mode = torch.stack([head.logits.argmax(dim=-1) for head in heads], dim=-1)
+    assert torch.allclose(dist.log_prob(samples), expected_log_prob)
+    assert torch.allclose(dist.entropy(), expected_entropy)
+    assert torch.equal(dist.mode(), expected_mode)
+
 def test_entropy_shape(example_logits_and_nvec):
     logits, nvec = example_logits_and_nvec
     dist = MultiCategorical(logits, nvec)
@@ -48,3 +135,71 @@ def test_mode_shape(example_logits_and_nvec):
 
     expected_shape = dist.batch_shape + dist.event_shape
     assert modes.shape == expected_shape, f"Expected shape {expected_shape}, got {modes.shape}"
+
+def test_discounted_reverse_cumsum_matches_loop():
+    x = torch.randn(16, 3)
+    discounts = torch.rand(16, 3)
+    discounts[5] = 0.  # Episode boundary.
+
+    expected = torch.zeros_like(x)
+    acc = torch.zeros(3)
+    for t in reversed(range(x.shape[0])):
+        acc = x[t] + discounts[t] * acc
+        expected[t] = acc
+
+    assert torch.allclose(discounted_reverse_cumsum(x, discounts), expected)
+
+def test_first_minibatch_ratio_is_one_under_autocast(autocast_trainer):
+    trainer = autocast_trainer
+    states, actions, rewards, values, log_probs, dones, final_value = trainer.collect_rollout(max_steps=64)
+    states, actions, log_probs = states.flatten(0, 1), actions.flatten(0, 1), log_probs.flatten(0, 1)
+    returns, advantages = rewards.flatten(0, 1), torch.randn(states.shape[0])
+
+    # With one epoch and one minibatch, the reported KL is the one measured before the only update.
+    metrics = trainer.train_step(states, actions, log_probs, advantages, returns)
+
+    assert abs(metrics['kl_div']) < 1e-6
+
+def test_step_info_reads_both_final_info_layouts():
+    done = np.array([False, True, False])
+    info = {'relative_distance': np.array([1., 5., 3.]), '_relative_distance': np.ones(3, dtype=bool)}
+    # gymnasium >= 1.0: dict of arrays
+    new_info = dict(info, final_info={'relative_distance': np.array([0., 2., 0.])}, _final_info=done)
+    # gymnasium < 1.0: object array of per-env dicts
+    old_final_info = np.array([None, {'relative_distance': 2.}, None], dtype=object)
+    old_info = dict(info, final_info=old_final_info, _final_info=done)
+
+    expected = np.array([1., 2., 3.])
+    assert np.array_equal(step_info(new_info, 'relative_distance', done), expected)
+    assert np.array_equal(step_info(old_info, 'relative_distance', done), expected)
+    assert np.array_equal(step_info(info, 'relative_distance', np.zeros(3, dtype=bool)), info['relative_distance'])
+
+def test_async_sub_envs_spawn_differently(async_vector_trainer):
+    trainer = async_vector_trainer
+    for _ in range(2):
+        states = trainer.reset_envs()
+        assert not np.allclose(states[0], states[1])
+
+def test_vector_rollout_shapes_and_per_env_gae(sync_vector_trainer):
+    trainer = sync_vector_trainer
+    states, actions, rewards, values, log_probs, dones, final_value = trainer.collect_rollout(max_steps=16)
+
+    assert states.shape == (16, 2, trainer.state_dim)
+    assert actions.shape == (16, 2, trainer.action_dim)
+    for buf in (rewards, values, log_probs, dones):
+        assert buf.shape == (16, 2)
+    assert final_value.shape == (2,)
+    assert not torch.allclose(states[0, 0], states[0, 1])  # The sub-envs run their own episodes.
+
+    advantages, returns = trainer.compute_gae(rewards, values, dones, final_value)
+    for env_idx in range(2):
+        expected = torch.zeros(16)
+        gae, next_value = 0., final_value[env_idx]
+        for t in reversed(range(16)):
+            not_done = 1. - dones[t, env_idx]
+            delta = rewards[t, env_idx] + trainer.gamma * next_value * not_done - values[t, env_idx]
+            gae = delta + trainer.gamma * trainer.gae_lambda * not_done * gae
+            expected[t] = gae
+            next_value = values[t, env_idx]
+        assert torch.allclose(advantages[:, env_idx], expected, atol=1e-5)
+        assert torch.allclose(returns[:, env_idx], expected + values[:, env_idx], atol=1e-5)
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+import gymnasium as gym
+import gym_carla
+from ppo_selfplay_trainer import PPOSelfPlayTrainer
+
+
+@pytest.fixture
+def selfplay_trainer_with_continuous_action(tmp_path):
+    env = gym.make('barc-laps-v1', track_name='L_track_barc', do_render=False, enable_camera=False,
+                   discrete_action=False)
+    return PPOSelfPlayTrainer(env=env, device='cpu', log_dir=str(tmp_path), max_steps=8)
+
+
+def test_collect_rollout_continuous_log_probs(selfplay_trainer_with_continuous_action):
+    trainer = selfplay_trainer_with_continuous_action
+    states, actions, rewards, values, log_probs, dones, final_value = trainer.collect_rollout(max_steps=8)
+    assert log_probs.shape == (8,)
+    assert actions.shape == (8, trainer.action_dim)
+    assert np.isfinite(log_probs).all()